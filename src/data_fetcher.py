@@ -2,104 +2,356 @@
 data_fetcher.py - Fetch stock market data from Alpha Vantage API
 """
 
+import io
 import os
+import orjson
+import asyncio
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import pandas as pd
+import threading
 import time
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 import logging
 
+try:
+    import redis
+except ImportError:
+    redis = None
+
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+CACHE_TTL = 86400
+
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5
+REDIS_TIMEOUT = 1
+
+COLUMN_MAP = {
+    'timestamp': 'date',
+    'open': 'open_price',
+    'high': 'high_price',
+    'low': 'low_price',
+    'close': 'close_price',
+    'volume': 'volume'
+}
+PRICE_COLUMNS = ['open_price', 'high_price', 'low_price', 'close_price']
+CSV_DTYPES = {'open': 'float64', 'high': 'float64', 'low': 'float64', 'close': 'float64', 'volume': 'int64'}
+RECORD_COLUMNS = ['symbol', 'date', *PRICE_COLUMNS, 'volume', 'created_at']
+
+
+class TokenBucket:
+    """Thread-safe token bucket; acquire() blocks and acquire_async() awaits until tokens refill."""
+    
+    def __init__(self, capacity, refill_rate):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def _reserve(self, n):
+        """Take n tokens if available and return 0, otherwise return the seconds to wait."""
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self.last_refill
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.refill_rate)
+            self.last_refill = now
+            
+            if self.tokens >= n:
+                self.tokens -= n
+                return 0
+            
+            return (n - self.tokens) / self.refill_rate
+    
+    def acquire(self, n=1):
+        while True:
+            wait = self._reserve(n)
+            if not wait:
+                return
+            
+            logger.info(f"Rate limit reached, waiting {wait:.1f} seconds...")
+            time.sleep(wait)
+    
+    async def acquire_async(self, n=1):
+        while True:
+            wait = self._reserve(n)
+            if not wait:
+                return
+            
+            logger.info(f"Rate limit reached, waiting {wait:.1f} seconds...")
+            await asyncio.sleep(wait)
+
 
 class StockDataFetcher:
-    def __init__(self):
+    def __init__(self, max_concurrent=5, requests_per_minute=5):
         self.api_key = os.getenv('ALPHA_VANTAGE_API_KEY')
         if not self.api_key:
             raise ValueError("ALPHA_VANTAGE_API_KEY not found in .env file!")
         
         self.base_url = "https://www.alphavantage.co/query"
+        
+        # Keep-alive session so repeat calls skip the TCP + TLS handshake
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=10,
+            max_retries=Retry(total=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR, status_forcelist=RETRY_STATUSES)
+        )
+        self.session.mount('https://', adapter)
+        self.request_timeout = aiohttp.ClientTimeout(connect=5, total=30)
+        self.max_concurrent = max_concurrent
+        # Free tier allows 5 requests/minute; shared by every thread and coroutine
+        self.limiter = TokenBucket(capacity=requests_per_minute, refill_rate=requests_per_minute / 60)
         logger.info("Stock data fetcher initialized")
     
+    def _build_params(self, symbol, outputsize):
+        return {
+            'function': 'TIME_SERIES_DAILY',
+            'symbol': symbol,
+            'outputsize': outputsize,
+            'datatype': 'csv',
+            'apikey': self.api_key
+        }
+    
+    def _extract_csv(self, symbol, body):
+        # Errors still come back as JSON even when datatype=csv is requested
+        if body.lstrip().startswith('{'):
+            data = orjson.loads(body)
+            
+            if 'Error Message' in data:
+                logger.error(f"API Error: {data['Error Message']}")
+            elif 'Note' in data:
+                logger.warning(f"API Rate Limit: {data['Note']}")
+            else:
+                logger.error(f"Unexpected response for {symbol}")
+            return None
+        
+        days = body.strip().count('\n')
+        logger.info(f"[SUCCESS] Fetched {days} days of data for {symbol}")
+        return body
+    
     def fetch_daily_data(self, symbol, outputsize='compact'):
         try:
-            params = {
-                'function': 'TIME_SERIES_DAILY',
-                'symbol': symbol,
-                'outputsize': outputsize,
-                'apikey': self.api_key
-            }
+            params = self._build_params(symbol, outputsize)
             
+            self.limiter.acquire()
             logger.info(f"Fetching data for {symbol}...")
-            response = requests.get(self.base_url, params=params)
+            response = self.session.get(self.base_url, params=params, timeout=(5, 30))
             response.raise_for_status()
-            data = response.json()
             
-            if 'Error Message' in data:
-                logger.error(f"API Error: {data['Error Message']}")
-                return None
+            return self._extract_csv(symbol, response.text)
             
-            if 'Note' in data:
-                logger.warning(f"API Rate Limit: {data['Note']}")
-                return None
-            
-            if 'Time Series (Daily)' not in data:
-                logger.error(f"Unexpected response for {symbol}")
-                return None
+        except Exception as e:
+            logger.error(f"Error fetching {symbol}: {e}")
+            return None
+    
+    async def _afetch(self, session, symbol, outputsize='compact'):
+        try:
+            params = self._build_params(symbol, outputsize)
             
-            time_series = data['Time Series (Daily)']
-            logger.info(f"[SUCCESS] Fetched {len(time_series)} days of data for {symbol}")
-            return time_series
+            for attempt in range(MAX_RETRIES + 1):
+                await self.limiter.acquire_async()
+                logger.info(f"Fetching data for {symbol}...")
+                
+                async with session.get(self.base_url, params=params, timeout=self.request_timeout) as response:
+                    if response.status not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                        response.raise_for_status()
+                        body = await response.text()
+                        return self._extract_csv(symbol, body)
+                    
+                    delay = BACKOFF_FACTOR * 2 ** attempt
+                    logger.warning(f"HTTP {response.status} for {symbol}, retrying in {delay:.1f} seconds...")
+                
+                await asyncio.sleep(delay)
             
         except Exception as e:
             logger.error(f"Error fetching {symbol}: {e}")
             return None
     
-    def parse_stock_data(self, symbol, time_series_data):
-        parsed_data = []
-        
-        for date_str, values in time_series_data.items():
-            try:
-                record = {
-                    'symbol': symbol,
-                    'date': datetime.strptime(date_str, '%Y-%m-%d'),
-                    'open_price': float(values['1. open']),
-                    'high_price': float(values['2. high']),
-                    'low_price': float(values['3. low']),
-                    'close_price': float(values['4. close']),
-                    'volume': int(values['5. volume']),
-                    'created_at': datetime.now()
-                }
-                parsed_data.append(record)
-            except (KeyError, ValueError) as e:
-                logger.error(f"Error parsing {symbol} on {date_str}: {e}")
-                continue
+    def _read_csv(self, csv_data):
+        try:
+            # Pinned dtypes let the C reader fill float64/int64 arrays without inference
+            return pd.read_csv(io.StringIO(csv_data), dtype=CSV_DTYPES)
+        except pd.errors.ParserError:
+            raise
+        except ValueError:
+            # A malformed number; read untyped and let parse_stock_data drop the bad rows
+            return pd.read_csv(io.StringIO(csv_data))
+    
+    def parse_stock_data(self, symbol, csv_data):
+        try:
+            df = self._read_csv(csv_data).rename(columns=COLUMN_MAP)
+            dates = pd.to_datetime(df['date'], format='%Y-%m-%d', errors='coerce')
+            values = df[PRICE_COLUMNS + ['volume']].apply(pd.to_numeric, errors='coerce')
+        except (KeyError, ValueError) as e:
+            logger.error(f"Error parsing {symbol}: {e}")
+            return pd.DataFrame(columns=RECORD_COLUMNS)
+        
+        invalid = values.isna().any(axis=1) | dates.isna()
+        if invalid.any():
+            logger.error(f"Error parsing {symbol} on {', '.join(df.loc[invalid, 'date'].astype(str))}")
+        
+        parsed_data = values[~invalid].astype({**dict.fromkeys(PRICE_COLUMNS, 'float64'), 'volume': 'int64'})
+        parsed_data['date'] = dates[~invalid]
+        parsed_data['symbol'] = symbol
+        parsed_data['created_at'] = datetime.now()
+        parsed_data = parsed_data[RECORD_COLUMNS].reset_index(drop=True)
         
         logger.info(f"Parsed {len(parsed_data)} records for {symbol}")
         return parsed_data
     
-    def fetch_multiple_symbols(self, symbols, delay=12):
-        all_data = {}
+    def client_session(self):
+        connector = aiohttp.TCPConnector(limit=self.max_concurrent)
+        return aiohttp.ClientSession(connector=connector)
+    
+    async def fetch_symbol_async(self, session, symbol, outputsize='compact'):
+        csv_data = await self._afetch(session, symbol, outputsize)
         
-        for i, symbol in enumerate(symbols):
-            logger.info(f"Processing {symbol} ({i+1}/{len(symbols)})...")
-            
-            time_series = self.fetch_daily_data(symbol)
-            
-            if time_series:
-                parsed_data = self.parse_stock_data(symbol, time_series)
-                all_data[symbol] = parsed_data
-                
-                if i < len(symbols) - 1:
-                    logger.info(f"Waiting {delay} seconds...")
-                    time.sleep(delay)
-            else:
-                logger.warning(f"Skipping {symbol}")
-                all_data[symbol] = []
+        if not csv_data:
+            logger.warning(f"Skipping {symbol}")
+            return pd.DataFrame(columns=RECORD_COLUMNS)
+        
+        return self.parse_stock_data(symbol, csv_data)
+    
+    async def fetch_multiple_symbols_async(self, symbols, outputsize='compact'):
+        logger.info(f"Fetching {len(symbols)} symbols concurrently...")
+        
+        async with self.client_session() as session:
+            results = await asyncio.gather(
+                *[self.fetch_symbol_async(session, symbol, outputsize) for symbol in symbols]
+            )
+        
+        return dict(zip(symbols, results))
+    
+    def fetch_multiple_symbols(self, symbols, outputsize='compact'):
+        return asyncio.run(self.fetch_multiple_symbols_async(symbols, outputsize))
+
+
+
+class CachedStockDataFetcher(StockDataFetcher):
+    """Serves repeat fetches from an in-process LRU, backed by Redis when REDIS_URL is set."""
+    
+    def __init__(self, ttl=CACHE_TTL, max_local_entries=128, **kwargs):
+        super().__init__(**kwargs)
+        
+        self.ttl = ttl
+        self.max_local_entries = max_local_entries
+        self._local = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        
+        self.redis = None
+        redis_url = os.getenv('REDIS_URL')
+        if redis_url and redis is not None:
+            # Short timeouts so an unreachable Redis degrades to a direct fetch quickly
+            self.redis = redis.Redis.from_url(
+                redis_url,
+                decode_responses=True,
+                socket_connect_timeout=REDIS_TIMEOUT,
+                socket_timeout=REDIS_TIMEOUT
+            )
+            logger.info("Redis cache enabled")
+        elif redis_url:
+            logger.warning("REDIS_URL is set but the redis package is not installed")
+    
+    def _cache_key(self, symbol, outputsize):
+        return f"av:{symbol}:{outputsize}:{datetime.now(timezone.utc).strftime('%Y%m%d')}"
+    
+    def _remember(self, key, value):
+        self._local[key] = value
+        self._local.move_to_end(key)
+        if len(self._local) > self.max_local_entries:
+            self._local.popitem(last=False)
+    
+    def _local_get(self, key):
+        if key not in self._local:
+            return None
+        
+        self._local.move_to_end(key)
+        return self._local[key]
+    
+    def _redis_get(self, key):
+        if self.redis is None:
+            return None
+        
+        try:
+            return self.redis.get(key)
+        except redis.RedisError as e:
+            logger.warning(f"Redis unavailable, fetching directly: {e}")
+            return None
+    
+    def _redis_set(self, key, value):
+        if self.redis is None:
+            return
+        
+        try:
+            self.redis.setex(key, self.ttl, value)
+        except redis.RedisError as e:
+            logger.warning(f"Redis unavailable, not caching: {e}")
+    
+    def _count(self, symbol, cached):
+        if cached is not None:
+            self.hits += 1
+            logger.info(f"Cache hit for {symbol} (hits={self.hits}, misses={self.misses})")
+        else:
+            self.misses += 1
+            logger.info(f"Cache miss for {symbol} (hits={self.hits}, misses={self.misses})")
+    
+    def _lookup(self, symbol, outputsize):
+        key = self._cache_key(symbol, outputsize)
+        cached = self._local_get(key)
+        
+        if cached is None:
+            cached = self._redis_get(key)
+            if cached is not None:
+                self._remember(key, cached)
+        
+        self._count(symbol, cached)
+        return key, cached
+    
+    async def _alookup(self, symbol, outputsize):
+        key = self._cache_key(symbol, outputsize)
+        cached = self._local_get(key)
+        
+        # The redis client is blocking; keep it off the event loop
+        if cached is None and self.redis is not None:
+            cached = await asyncio.to_thread(self._redis_get, key)
+            if cached is not None:
+                self._remember(key, cached)
+        
+        self._count(symbol, cached)
+        return key, cached
+    
+    def fetch_daily_data(self, symbol, outputsize='compact'):
+        key, cached = self._lookup(symbol, outputsize)
+        if cached is not None:
+            return cached
+        
+        csv_data = super().fetch_daily_data(symbol, outputsize)
+        if csv_data:
+            self._remember(key, csv_data)
+            self._redis_set(key, csv_data)
+        return csv_data
+    
+    async def _afetch(self, session, symbol, outputsize='compact'):
+        key, cached = await self._alookup(symbol, outputsize)
+        if cached is not None:
+            return cached
         
-        return all_data
+        csv_data = await super()._afetch(session, symbol, outputsize)
+        if csv_data:
+            self._remember(key, csv_data)
+            if self.redis is not None:
+                await asyncio.to_thread(self._redis_set, key, csv_data)
+        return csv_data
 
 
 if __name__ == "__main__":
@@ -113,17 +365,17 @@ if __name__ == "__main__":
         test_symbol = 'AAPL'
         print(f"\nFetching data for {test_symbol}...")
         
-        time_series = fetcher.fetch_daily_data(test_symbol, outputsize='compact')
+        csv_data = fetcher.fetch_daily_data(test_symbol, outputsize='compact')
         
-        if time_series:
-            print(f"[SUCCESS] Fetched {len(time_series)} days of data")
+        if csv_data:
+            print(f"[SUCCESS] Fetched {len(csv_data):,} bytes of CSV")
             
-            parsed_data = fetcher.parse_stock_data(test_symbol, time_series)
+            parsed_data = fetcher.parse_stock_data(test_symbol, csv_data)
             print(f"[SUCCESS] Parsed {len(parsed_data)} records")
             
-            if parsed_data:
+            if not parsed_data.empty:
                 print("\n[STATS] Sample Record:")
-                sample = parsed_data[0]
+                sample = parsed_data.iloc[0]
                 print(f"   Symbol: {sample['symbol']}")
                 print(f"   Date: {sample['date']}")
                 print(f"   Close: ${sample['close_price']:.2f}")
@@ -2,8 +2,18 @@
 database.py - Database connection and schema management
 """
 
+import hashlib
+import io
 import os
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, Index, text
+import re
+import shlex
+from decimal import Decimal
+import pandas as pd
+from sqlalchemy import create_engine, func, literal, Column, BigInteger, Numeric, String, DateTime, Index, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from dotenv import load_dotenv
@@ -15,22 +25,25 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 Base = declarative_base()
 
+MAX_BIND_PARAMS = 32767
+
 
 class StockPrice(Base):
     __tablename__ = 'stock_prices'
     
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    symbol = Column(String(10), nullable=False, index=True)
-    date = Column(DateTime, nullable=False, index=True)
-    open_price = Column(Float, nullable=False)
-    high_price = Column(Float, nullable=False)
-    low_price = Column(Float, nullable=False)
-    close_price = Column(Float, nullable=False)
-    volume = Column(Integer, nullable=False)
+    # Postgres requires the partition key (symbol) in every unique constraint
+    symbol = Column(String(10), primary_key=True)
+    date = Column(DateTime, primary_key=True)
+    open_price = Column(Numeric(12, 4), nullable=False)
+    high_price = Column(Numeric(12, 4), nullable=False)
+    low_price = Column(Numeric(12, 4), nullable=False)
+    close_price = Column(Numeric(12, 4), nullable=False)
+    volume = Column(BigInteger, nullable=False)
     created_at = Column(DateTime, nullable=False)
     
     __table_args__ = (
-        Index('idx_symbol_date', 'symbol', 'date', unique=True),
+        Index('idx_date_brin', 'date', postgresql_using='brin'),
+        {'postgresql_partition_by': 'LIST (symbol)'},
     )
     
     def __repr__(self):
@@ -43,22 +56,388 @@ class DatabaseManager:
         if not self.db_url:
             raise ValueError("DB_URL not found in .env file!")
         
+        self.is_postgres = make_url(self.db_url).get_backend_name() == 'postgresql'
+        
+        # Serves setup, freshness checks, backfill and reporting; the default pool is plenty
         self.engine = create_engine(self.db_url, pool_pre_ping=True, echo=False)
         self.SessionLocal = sessionmaker(bind=self.engine)
+        
+        # Parallel stores (has_prices, inserts and first-load COPY) all run on asyncpg,
+        # one pooled connection per in-flight symbol
+        self.async_engine = None
+        if self.is_postgres:
+            async_url, connect_args = self._async_url()
+            self.async_engine = create_async_engine(
+                async_url, pool_pre_ping=True, pool_size=10, connect_args=connect_args
+            )
+            self.AsyncSessionLocal = async_sessionmaker(self.async_engine, expire_on_commit=False)
         logger.info("Database connection established")
     
+    def _async_url(self):
+        """Translate the libpq-style DB_URL into an asyncpg URL and its connect_args.
+        
+        ASYNC_DB_URL, when set, is used as-is for the async engine.
+        """
+        override = os.getenv('ASYNC_DB_URL')
+        if override:
+            return make_url(override), {}
+        
+        url = make_url(self.db_url).set(drivername='postgresql+asyncpg')
+        query = dict(url.query)
+        connect_args = {}
+        server_settings = {}
+        
+        # asyncpg takes libpq's sslmode as ssl
+        if 'sslmode' in query:
+            connect_args['ssl'] = query.pop('sslmode')
+        if 'connect_timeout' in query:
+            connect_args['timeout'] = float(query.pop('connect_timeout'))
+        if 'application_name' in query:
+            server_settings['application_name'] = query.pop('application_name')
+        if 'options' in query:
+            server_settings.update(self._parse_pg_options(query.pop('options')))
+        
+        if server_settings:
+            connect_args['server_settings'] = server_settings
+        for key in query:
+            logger.warning(f"Ignoring {key} in DB_URL for the asyncpg engine; set ASYNC_DB_URL to override")
+        
+        return url.set(query={}), connect_args
+    
+    @staticmethod
+    def _parse_pg_options(options):
+        """Turn libpq's options string ("-c key=value --key=value") into server settings."""
+        settings = {}
+        args = shlex.split(options)
+        for i, arg in enumerate(args):
+            if arg == '-c' and i + 1 < len(args):
+                setting = args[i + 1]
+            elif arg.startswith('-c') and arg != '-c':
+                setting = arg[2:]
+            elif arg.startswith('--'):
+                setting = arg[2:]
+            else:
+                continue
+            
+            key, sep, value = setting.partition('=')
+            if sep:
+                settings[key.replace('-', '_')] = value
+        return settings
+    
     def create_tables(self):
         try:
             Base.metadata.create_all(self.engine)
+            self._upgrade_schema()
+            self._create_default_partition()
+            self._create_latest_prices_view()
             logger.info("Database tables created successfully")
             return True
         except Exception as e:
             logger.error(f"Error creating tables: {e}")
             return False
     
+    def _upgrade_schema(self):
+        """Bring a stock_prices table created by an older version in line with the model."""
+        if not self.is_postgres:
+            return
+        
+        with self.engine.begin() as conn:
+            column_types = dict(conn.execute(text(
+                "SELECT column_name, data_type FROM information_schema.columns "
+                "WHERE table_name = 'stock_prices'"
+            )).fetchall())
+            
+            if column_types.get('volume') != 'bigint' or column_types.get('close_price') != 'numeric':
+                logger.info("Migrating stock_prices to BIGINT volume and NUMERIC(12,4) prices...")
+                conn.execute(text(
+                    "ALTER TABLE stock_prices "
+                    "ALTER COLUMN volume TYPE BIGINT, "
+                    "ALTER COLUMN open_price TYPE NUMERIC(12, 4), "
+                    "ALTER COLUMN high_price TYPE NUMERIC(12, 4), "
+                    "ALTER COLUMN low_price TYPE NUMERIC(12, 4), "
+                    "ALTER COLUMN close_price TYPE NUMERIC(12, 4)"
+                ))
+            
+            # idx_symbol_date already serves symbol lookups; date scans use the BRIN index
+            conn.execute(text("DROP INDEX IF EXISTS ix_stock_prices_symbol"))
+            conn.execute(text("DROP INDEX IF EXISTS ix_stock_prices_date"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_date_brin ON stock_prices USING brin (date)"))
+    
+    def _is_partitioned(self, conn):
+        return conn.execute(text(
+            "SELECT relkind FROM pg_class WHERE oid = to_regclass('stock_prices')"
+        )).scalar() == 'p'
+    
+    def _create_default_partition(self):
+        if not self.is_postgres:
+            return
+        
+        with self.engine.begin() as conn:
+            if not self._is_partitioned(conn):
+                logger.warning("stock_prices was created before partitioning; leaving it unpartitioned")
+                return
+            
+            conn.execute(text(
+                "CREATE TABLE IF NOT EXISTS stock_prices_default PARTITION OF stock_prices DEFAULT"
+            ))
+    
+    def _partition_name(self, symbol):
+        # The hash keeps symbols that sanitize alike (BRK.B, BRK-B) in separate partitions
+        digest = hashlib.sha1(symbol.encode()).hexdigest()[:8]
+        slug = re.sub(r'\W', '_', symbol.lower())
+        return f"stock_prices_{slug}_{digest}"
+    
+    def ensure_partitions(self, symbols):
+        """Give each symbol its own LIST partition so its index stays small."""
+        if not self.is_postgres:
+            return
+        
+        with self.engine.begin() as conn:
+            if not self._is_partitioned(conn):
+                return
+            
+            existing_bounds = set(conn.execute(text(
+                "SELECT pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = to_regclass('stock_prices')"
+            )).scalars())
+            preparer = conn.dialect.identifier_preparer
+            
+            for symbol in symbols:
+                value = literal(symbol, String()).compile(
+                    dialect=conn.dialect,
+                    compile_kwargs={'literal_binds': True}
+                )
+                bound = f"FOR VALUES IN ({value})"
+                if bound in existing_bounds:
+                    continue
+                
+                partition = preparer.quote(self._partition_name(symbol))
+                conn.execute(text(f"CREATE TABLE {partition} PARTITION OF stock_prices {bound}"))
+    
+    def _create_latest_prices_view(self):
+        """Materialize the newest row per symbol, with the prior close, for the report."""
+        if not self.is_postgres:
+            return
+        
+        with self.engine.begin() as conn:
+            conn.execute(text(
+                "CREATE MATERIALIZED VIEW IF NOT EXISTS latest_prices AS "
+                "SELECT DISTINCT ON (symbol) symbol, date, close_price, volume, "
+                "LAG(close_price) OVER (PARTITION BY symbol ORDER BY date) AS previous_close "
+                "FROM stock_prices ORDER BY symbol, date DESC"
+            ))
+            # A unique index is required for REFRESH ... CONCURRENTLY
+            conn.execute(text(
+                "CREATE UNIQUE INDEX IF NOT EXISTS idx_latest_prices_symbol ON latest_prices (symbol)"
+            ))
+    
+    def refresh_latest_prices(self):
+        if not self.is_postgres:
+            return True
+        
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(text("REFRESH MATERIALIZED VIEW CONCURRENTLY latest_prices"))
+            logger.info("Refreshed latest_prices view")
+            return True
+        except Exception as e:
+            logger.error(f"Error refreshing latest_prices view: {e}")
+            return False
+    
+    def latest_prices_stale(self, freshness):
+        """True when the view lags the newest stored date of any symbol in freshness."""
+        if not self.is_postgres or not freshness:
+            return False
+        
+        try:
+            with self.engine.connect() as conn:
+                rows = conn.execute(
+                    text("SELECT symbol, date FROM latest_prices WHERE symbol = ANY(:symbols)"),
+                    {'symbols': list(freshness)}
+                ).fetchall()
+        except Exception as e:
+            logger.error(f"Error reading latest_prices view: {e}")
+            return True
+        
+        view_dates = {symbol: latest.date() for symbol, latest in rows}
+        return any(view_dates.get(symbol) != latest for symbol, latest in freshness.items())
+    
+    def get_latest_prices(self, session, symbols):
+        """Return the newest row per symbol with symbol, date, close_price, volume and previous_close."""
+        if self.is_postgres:
+            return session.execute(
+                text("SELECT * FROM latest_prices WHERE symbol = ANY(:symbols)"),
+                {'symbols': list(symbols)}
+            ).fetchall()
+        
+        ranked = session.query(
+            StockPrice.symbol,
+            StockPrice.date,
+            StockPrice.close_price,
+            StockPrice.volume,
+            func.lag(StockPrice.close_price, type_=StockPrice.close_price.type).over(
+                partition_by=StockPrice.symbol,
+                order_by=StockPrice.date
+            ).label('previous_close'),
+            func.row_number().over(
+                partition_by=StockPrice.symbol,
+                order_by=StockPrice.date.desc()
+            ).label('rn')
+        ).filter(StockPrice.symbol.in_(symbols)).subquery()
+        
+        return session.query(ranked).filter(ranked.c.rn == 1).all()
+    
     def get_session(self):
         return self.SessionLocal()
     
+    def get_async_session(self):
+        return self.AsyncSessionLocal()
+    
+    def insert_stock_prices(self, session, rows):
+        """Insert rows, skipping (symbol, date) pairs already stored. Returns the count inserted."""
+        if not rows:
+            return 0
+        
+        if self.is_postgres:
+            # asyncpg rejects statements with more bind parameters than this
+            batch_size = MAX_BIND_PARAMS // len(StockPrice.__table__.columns)
+            stored = 0
+            
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                stmt = pg_insert(StockPrice.__table__).values(batch).on_conflict_do_nothing(
+                    index_elements=['symbol', 'date']
+                )
+                stored += session.execute(stmt).rowcount
+            
+            return stored
+        
+        try:
+            session.bulk_insert_mappings(StockPrice, rows)
+            session.flush()
+            return len(rows)
+        except IntegrityError:
+            session.rollback()
+        
+        symbols = {row['symbol'] for row in rows}
+        dates = [row['date'] for row in rows]
+        # Only keys inside the batch's date range can collide, so skip the rest of the history
+        existing = set(
+            session.query(StockPrice.symbol, StockPrice.date)
+            .filter(
+                StockPrice.symbol.in_(symbols),
+                StockPrice.date.between(min(dates), max(dates))
+            )
+            .all()
+        )
+        new_rows = [row for row in rows if (row['symbol'], row['date']) not in existing]
+        session.bulk_insert_mappings(StockPrice, new_rows)
+        session.flush()
+        return len(new_rows)
+    
+    def has_prices(self, session, symbol):
+        return session.query(StockPrice.symbol).filter_by(symbol=symbol).first() is not None
+    
+    def _csv_buffer(self, df):
+        columns = [column.name for column in StockPrice.__table__.columns]
+        return columns, io.StringIO(df[columns].to_csv(index=False, header=False))
+    
+    def bulk_copy(self, df):
+        """Stream a DataFrame into stock_prices with COPY. Rows must not already be stored."""
+        if df.empty:
+            return 0
+        
+        columns, buffer = self._csv_buffer(df)
+        
+        raw_conn = self.engine.raw_connection()
+        try:
+            cursor = raw_conn.cursor()
+            cursor.copy_expert(
+                f"COPY stock_prices ({', '.join(columns)}) FROM STDIN WITH CSV",
+                buffer
+            )
+            raw_conn.commit()
+            return len(df)
+        except Exception:
+            raw_conn.rollback()
+            raise
+        finally:
+            raw_conn.close()
+    
+    async def bulk_copy_async(self, session, df):
+        """bulk_copy over the async session's own asyncpg connection; the caller commits."""
+        if df.empty:
+            return 0
+        
+        columns = [column.name for column in StockPrice.__table__.columns]
+        # asyncpg's binary COPY wants native datetimes, Decimals and ints rather than numpy scalars
+        records = [
+            (
+                row.symbol,
+                pd.Timestamp(row.date).to_pydatetime(),
+                Decimal(str(row.open_price)),
+                Decimal(str(row.high_price)),
+                Decimal(str(row.low_price)),
+                Decimal(str(row.close_price)),
+                int(row.volume),
+                pd.Timestamp(row.created_at).to_pydatetime(),
+            )
+            for row in df[columns].itertuples(index=False)
+        ]
+        
+        conn = await session.connection()
+        raw_conn = await conn.get_raw_connection()
+        await raw_conn.driver_connection.copy_records_to_table(
+            'stock_prices', records=records, columns=columns
+        )
+        return len(records)
+    
+    def bulk_ingest(self, df):
+        """COPY into a temporary (unlogged) staging table, then merge into stock_prices in one transaction."""
+        if df.empty:
+            return 0
+        
+        if not self.is_postgres:
+            session = self.get_session()
+            try:
+                stored = self.insert_stock_prices(session, df.to_dict('records'))
+                session.commit()
+                return stored
+            finally:
+                session.close()
+        
+        columns, buffer = self._csv_buffer(df)
+        
+        raw_conn = self.engine.raw_connection()
+        try:
+            cursor = raw_conn.cursor()
+            column_list = ', '.join(columns)
+            
+            # Temp tables skip the WAL like UNLOGGED ones, and are private to this
+            # transaction, so every ingest starts from the current schema and leaves nothing behind
+            cursor.execute(
+                "CREATE TEMP TABLE stock_prices_staging "
+                "(LIKE stock_prices INCLUDING DEFAULTS) ON COMMIT DROP"
+            )
+            cursor.copy_expert(
+                f"COPY stock_prices_staging ({column_list}) FROM STDIN WITH CSV",
+                buffer
+            )
+            cursor.execute(
+                f"INSERT INTO stock_prices ({column_list}) "
+                f"SELECT {column_list} FROM stock_prices_staging "
+                "ON CONFLICT (symbol, date) DO NOTHING"
+            )
+            stored = cursor.rowcount
+            raw_conn.commit()
+            return stored
+        except Exception:
+            raw_conn.rollback()
+            raise
+        finally:
+            raw_conn.close()
+    
     def test_connection(self):
         try:
             session = self.get_session()
@@ -70,25 +449,34 @@ class DatabaseManager:
             logger.error(f"Database connection test failed: {e}")
             return False
     
+    def latest_date_per_symbol(self, symbols):
+        session = self.get_session()
+        try:
+            rows = session.query(
+                StockPrice.symbol,
+                func.max(StockPrice.date)
+            ).filter(StockPrice.symbol.in_(symbols)).group_by(StockPrice.symbol).all()
+            
+            return {symbol: latest.date() for symbol, latest in rows}
+        finally:
+            session.close()
+    
     def get_table_stats(self):
         try:
             session = self.get_session()
-            total_records = session.query(StockPrice).count()
-            unique_symbols = session.query(StockPrice.symbol).distinct().count()
-            
-            from sqlalchemy import func
-            date_range = session.query(
-                func.min(StockPrice.date).label('earliest'),
-                func.max(StockPrice.date).label('latest')
-            ).first()
-            
+            total_records, unique_symbols, earliest_date, latest_date = session.query(
+                func.count(),
+                func.count(func.distinct(StockPrice.symbol)),
+                func.min(StockPrice.date),
+                func.max(StockPrice.date)
+            ).one()
             session.close()
             
             return {
                 'total_records': total_records,
                 'unique_symbols': unique_symbols,
-                'earliest_date': date_range.earliest,
-                'latest_date': date_range.latest
+                'earliest_date': earliest_date,
+                'latest_date': latest_date
             }
         except Exception as e:
             logger.error(f"Error getting stats: {e}")
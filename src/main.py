@@ -3,9 +3,12 @@ main.py - Main execution script for Financial Analytics Pipeline
 Hardik Chauhan
 """
 
-from database import DatabaseManager, StockPrice
-from data_fetcher import StockDataFetcher
-from datetime import datetime
+import asyncio
+import sys
+import pandas as pd
+from database import DatabaseManager
+from data_fetcher import CachedStockDataFetcher
+from datetime import date, timedelta
 import logging
 
 logging.basicConfig(
@@ -14,13 +17,16 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 'compact' returns the last 100 trading days, which covers any gap this many calendar days long
+COMPACT_WINDOW_DAYS = 100
+
 
 class FinancialAnalyticsPipeline:
     def __init__(self):
         logger.info("Initializing Financial Analytics Pipeline...")
         
         self.db_manager = DatabaseManager()
-        self.data_fetcher = StockDataFetcher()
+        self.data_fetcher = CachedStockDataFetcher()
         
         self.symbols = ['JPM', 'BAC', 'WFC', 'GS', 'MS']
         logger.info(f"Tracking {len(self.symbols)} symbols: {', '.join(self.symbols)}")
@@ -39,48 +45,107 @@ class FinancialAnalyticsPipeline:
         logger.info("✅ Database setup complete")
         return True
     
-    def fetch_and_store_data(self):
-        logger.info("Starting data fetch and storage...")
-        
-        all_data = self.data_fetcher.fetch_multiple_symbols(self.symbols)
+    def _store_symbol(self, symbol, records):
+        logger.info(f"Storing data for {symbol}...")
         
         session = self.db_manager.get_session()
-        total_stored = 0
-        total_skipped = 0
-        
         try:
-            for symbol, records in all_data.items():
-                logger.info(f"Storing data for {symbol}...")
-                
-                for record in records:
-                    existing = session.query(StockPrice).filter_by(
-                        symbol=record['symbol'],
-                        date=record['date']
-                    ).first()
-                    
-                    if existing:
-                        total_skipped += 1
-                        continue
-                    
-                    stock_price = StockPrice(**record)
-                    session.add(stock_price)
-                    total_stored += 1
-                
+            if self.db_manager.is_postgres and not self.db_manager.has_prices(session, symbol):
+                stored = self.db_manager.bulk_copy(records)
+            else:
+                stored = self.db_manager.insert_stock_prices(session, records.to_dict('records'))
                 session.commit()
-                logger.info(f"✅ Stored data for {symbol}")
             
-            logger.info(f"\n📊 Summary:")
-            logger.info(f"   Records stored: {total_stored}")
-            logger.info(f"   Records skipped: {total_skipped}")
+            logger.info(f"✅ Stored data for {symbol}")
+            return stored
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+    
+    async def _store_symbol_async(self, symbol, records):
+        if self.db_manager.async_engine is None:
+            return await asyncio.to_thread(self._store_symbol, symbol, records)
+        
+        logger.info(f"Storing data for {symbol}...")
+        
+        async with self.db_manager.get_async_session() as session:
+            if await session.run_sync(self.db_manager.has_prices, symbol):
+                stored = await session.run_sync(
+                    self.db_manager.insert_stock_prices, records.to_dict('records')
+                )
+            else:
+                stored = await self.db_manager.bulk_copy_async(session, records)
+            await session.commit()
+        
+        logger.info(f"✅ Stored data for {symbol}")
+        return stored
+    
+    async def _fetch_and_store_symbol(self, http_session, symbol, outputsize):
+        records = await self.data_fetcher.fetch_symbol_async(http_session, symbol, outputsize)
+        stored = await self._store_symbol_async(symbol, records)
+        return len(records), stored
+    
+    async def fetch_and_store_data(self):
+        logger.info("Starting data fetch and storage...")
+        
+        today = date.today()
+        
+        try:
+            freshness = self.db_manager.latest_date_per_symbol(self.symbols)
             
-            return True
+            symbols_to_fetch = [
+                symbol for symbol in self.symbols
+                if freshness.get(symbol, date.min) < today - timedelta(days=1)
+            ]
             
+            self.db_manager.ensure_partitions(symbols_to_fetch)
         except Exception as e:
-            logger.error(f"Error storing data: {e}")
-            session.rollback()
+            logger.error(f"Error preparing data fetch: {e}")
             return False
-        finally:
-            session.close()
+        
+        skipped_symbols = len(self.symbols) - len(symbols_to_fetch)
+        if skipped_symbols:
+            logger.info(f"Skipping {skipped_symbols} symbols that are already up to date")
+        
+        full_cutoff = today - timedelta(days=COMPACT_WINDOW_DAYS)
+        plan = [
+            (symbol, 'full' if freshness.get(symbol, date.min) < full_cutoff else 'compact')
+            for symbol in symbols_to_fetch
+        ]
+        
+        # Each symbol is written as soon as it arrives, overlapping its INSERT with the other fetches
+        async with self.data_fetcher.client_session() as http_session:
+            results = await asyncio.gather(
+                *[self._fetch_and_store_symbol(http_session, symbol, outputsize) for symbol, outputsize in plan],
+                return_exceptions=True
+            )
+        
+        total_stored = 0
+        total_skipped = 0
+        failed = []
+        
+        for (symbol, _), result in zip(plan, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error storing data for {symbol}: {result}")
+                failed.append(symbol)
+                continue
+            
+            fetched, stored = result
+            total_stored += stored
+            total_skipped += fetched - stored
+        
+        refreshed = True
+        # Also catches up a view left behind by an earlier failed refresh
+        if total_stored or self.db_manager.latest_prices_stale(freshness):
+            refreshed = self.db_manager.refresh_latest_prices()
+        
+        logger.info(f"\n📊 Summary:")
+        logger.info(f"   Records stored: {total_stored}")
+        logger.info(f"   Records skipped: {total_skipped}")
+        
+        return refreshed and not failed
     
     def generate_analytics_report(self):
         logger.info("\n" + "=" * 70)
@@ -98,18 +163,18 @@ class FinancialAnalyticsPipeline:
                 print(f"   Symbols Tracked: {stats['unique_symbols']}")
                 print(f"   Date Range: {stats['earliest_date']} to {stats['latest_date']}")
             
-            from sqlalchemy import func
+            latest_prices = {
+                row.symbol: row
+                for row in self.db_manager.get_latest_prices(session, self.symbols)
+            }
             
             print(f"\n💰 Latest Stock Prices:")
             print(f"{'Symbol':<10} {'Date':<12} {'Close Price':<15} {'Volume':<15}")
             print("-" * 60)
             
             for symbol in self.symbols:
-                latest = session.query(StockPrice).filter_by(
-                    symbol=symbol
-                ).order_by(StockPrice.date.desc()).first()
-                
-                if latest:
+                if symbol in latest_prices:
+                    latest = latest_prices[symbol]
                     print(f"{latest.symbol:<10} {latest.date.strftime('%Y-%m-%d'):<12} "
                           f"${latest.close_price:<14.2f} {latest.volume:>14,}")
             
@@ -118,18 +183,13 @@ class FinancialAnalyticsPipeline:
             print("-" * 45)
             
             for symbol in self.symbols:
-                last_two = session.query(StockPrice).filter_by(
-                    symbol=symbol
-                ).order_by(StockPrice.date.desc()).limit(2).all()
+                latest = latest_prices.get(symbol)
                 
-                if len(last_two) == 2:
-                    current = last_two[0]
-                    previous = last_two[1]
-                    
-                    change = current.close_price - previous.close_price
-                    pct_change = (change / previous.close_price) * 100
+                if latest and latest.previous_close is not None:
+                    change = latest.close_price - latest.previous_close
+                    pct_change = (change / latest.previous_close) * 100
                     
-                    print(f"{symbol:<10} ${change:+.2f:<13} {pct_change:+.2f}%")
+                    print(f"{symbol:<10} {f'${change:+.2f}':<15} {pct_change:+.2f}%")
             
             logger.info("\n" + "=" * 70)
             logger.info("✅ Report generation complete")
@@ -140,31 +200,72 @@ class FinancialAnalyticsPipeline:
         finally:
             session.close()
     
-    def run(self):
-        logger.info("\n" + "=" * 70)
-        logger.info("STARTING FINANCIAL ANALYTICS PIPELINE")
-        logger.info("=" * 70 + "\n")
+    def backfill(self, symbols=None):
+        symbols = symbols or self.symbols
+        logger.info(f"Backfilling full history for {len(symbols)} symbols...")
+        
+        try:
+            self.db_manager.ensure_partitions(symbols)
+        except Exception as e:
+            logger.error(f"Error preparing backfill: {e}")
+            return False
+        
+        all_data = self.data_fetcher.fetch_multiple_symbols(symbols, outputsize='full')
+        frames = [records for records in all_data.values() if not records.empty]
+        
+        if not frames:
+            logger.error("No data fetched for backfill")
+            return False
         
-        if not self.setup_database():
-            logger.error("Pipeline aborted")
+        try:
+            stored = self.db_manager.bulk_ingest(pd.concat(frames, ignore_index=True))
+        except Exception as e:
+            logger.error(f"Error during backfill: {e}")
             return False
         
-        if not self.fetch_and_store_data():
-            logger.error("Pipeline aborted")
+        if stored and not self.db_manager.refresh_latest_prices():
             return False
         
-        self.generate_analytics_report()
+        logger.info(f"✅ Backfill stored {stored} new records")
+        return True
+    
+    async def run_async(self):
+        logger.info("\n" + "=" * 70)
+        logger.info("STARTING FINANCIAL ANALYTICS PIPELINE")
+        logger.info("=" * 70 + "\n")
+        
+        try:
+            if not self.setup_database():
+                logger.error("Pipeline aborted")
+                return False
+            
+            if not await self.fetch_and_store_data():
+                logger.error("Pipeline aborted")
+                return False
+            
+            self.generate_analytics_report()
+        finally:
+            # Pooled asyncpg connections are bound to this loop, which asyncio.run closes
+            if self.db_manager.async_engine is not None:
+                await self.db_manager.async_engine.dispose()
         
         logger.info("\n" + "=" * 70)
         logger.info("✅ PIPELINE EXECUTION COMPLETE")
         logger.info("=" * 70)
         
         return True
+    
+    def run(self):
+        return asyncio.run(self.run_async())
 
 
 if __name__ == "__main__":
     pipeline = FinancialAnalyticsPipeline()
-    success = pipeline.run()
+    
+    if '--backfill' in sys.argv:
+        success = pipeline.setup_database() and pipeline.backfill()
+    else:
+        success = pipeline.run()
     
     if not success:
         exit(1)